@@ -4,19 +4,28 @@ import json
 import logging
 import requests
 import argparse
+import functools
 import os
+import re
+import shutil
+import socket
 import time
+import urllib3
 
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html import unescape
+from requests.adapters import HTTPAdapter
 from time import localtime, strftime
+from urllib.parse import urlencode, urlparse
 
 
 class GoogleImagesScraper(object):
     """
     Class to scrap images from Google Images web page.
 
-    GoogleImagesScraper class scrap Google's page using BeautifulSoup4. It receives several arguments to configure
-    the scraper, like image extensions to download, output directory, prefix and suffix for image filenames, and more.
+    GoogleImagesScraper class scrap Google's page using regular expressions. It receives several arguments to
+    configure the scraper, like image extensions to download, output directory, prefix and suffix for image filenames,
+    and more.
 
     Attributes:
         exts: A list of strings with allowed extensions to download.
@@ -25,13 +34,27 @@ class GoogleImagesScraper(object):
         suffix: A string with the suffix used to name the image files.
         limit: An integer with the maximum amount of images to download.
         logger: A boolean to enabled logging.
+        workers: An integer with the maximum amount of images downloaded at the same time.
     """
 
+    # JSON data inside each image div, found straight in the raw HTML so the page is never parsed into a tree. The
+    # class attribute must follow whitespace, so attributes like 'data-class' do not match. Like an HTML parser, it
+    # accepts any case, spaces around '=', quoted or unquoted values and any text up to the closing tag
+    _RG_META_RE = re.compile(rb'<div\s(?:[^>]*?\s)?class\s*=\s*(?:"(?:[^"]*\s)?rg_meta(?:\s[^"]*)?"'
+                             rb'|\'(?:[^\']*\s)?rg_meta(?:\s[^\']*)?\'|rg_meta(?=[\s>]))[^>]*>(.*?)</div>',
+                             re.IGNORECASE | re.DOTALL)
+
+    # Image URL ('ou' value) inside the JSON data of each image div, so the rest of the JSON need not be parsed
+    _OU_RE = re.compile(r'"ou"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+    # Seconds to wait for a server before giving up, so a hung request does not block a download worker
+    _TIMEOUT = 10
+
     def __init__(self, exts=['jpg', 'jpeg', 'png', 'bmp'], output_dir=os.path.expanduser('~'),
-                 prefix='', suffix='', limit=100, logger=False):
+                 prefix='', suffix='', limit=100, logger=False, workers=16):
         """
         Init GoogleImagesScraper with allowed extensions, output directory, prefix, suffix, maximum number of files,
-        and logging option.
+        logging option and number of download workers.
 
         :param exts: A list of strings with allowed extensions to download.
         :param output_dir: A string with the path of the output directory.
@@ -39,11 +62,17 @@ class GoogleImagesScraper(object):
         :param suffix: A string with the suffix used to name the image files.
         :param limit: An integer with the maximum amount of images to download.
         :param logger: A boolean to enabled logging.
+        :param workers: An integer with the maximum amount of images downloaded at the same time.
         """
 
         # We will make (maybe) several request to the same host, so reusing the same TCP connection
         # result in a significant performance increase
         self.session = requests.Session()
+        # Images come from many different hosts and are downloaded concurrently, so keep connections to several
+        # hosts alive and allow one connection per worker to each of them
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=max(workers, 64))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.session.headers.update(
             {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/63.0.3239.108 Safari/537.36'}
         )
@@ -51,7 +80,7 @@ class GoogleImagesScraper(object):
         # Google Image search default parameters
         self.url = 'https://www.google.com.ar/search?'
         self.params = {'tbm': 'isch'}
-        self.allowed_exts = exts
+        self.allowed_exts = frozenset(ext.lower() for ext in exts)
 
         # By default, save images and log file in a folder inside home directory
         self.output_dir = output_dir
@@ -69,12 +98,12 @@ class GoogleImagesScraper(object):
         # Number of files in output_dir
         self.counter = 0
 
+        # Downloads are I/O bound, so several of them are run at the same time
+        self.workers = workers
+
         # Set logger
         self._set_logger(logger)
 
-        # Turn off SSL warnings
-        requests.packages.urllib3.disable_warnings()
-
     def _set_logger(self, has_logger):
         """
         Set logger configuration.
@@ -92,59 +121,88 @@ class GoogleImagesScraper(object):
         else:
             self.logger = logging.getLogger('None')
 
-    def _make_soup(self):
+    def _get_results_page(self):
         """
-        Create a tree structure using tags as nodes.
+        Get the Google Images results page for the current search params.
 
-        :return: BeautifulSoup object
+        :return: Bytes with the HTML content of the page
         """
-        self.logger.debug('Making URL')
         # Create the URL
-        url = self.url
-        for k, v in self.params.items():
-            url += '%s=%s&' % (k, v)
+        url = self.url + urlencode(self.params)
 
-        self.logger.debug('Getting URL content')
-        # Get the URL content and convert to a tree
-        request = self.session.get(url)
-        html = request.content
+        # Get the URL content
+        request = self.session.get(url, timeout=self._TIMEOUT)
+        return request.content
 
-        self.logger.debug('Returning BeautifulSoup tree')
-        return BeautifulSoup(html, "lxml")
+    def _iter_rg_meta(self, html):
+        """
+        Search the results page and yield the text of each image div as soon as it is found.
 
-    def _download_image(self, image_url):
+        Only the matched divs are copied out of the page, so no tree is built for the rest of the HTML.
+
+        :param html: Bytes with the HTML content of the results page
+        :return: A generator of strings with the JSON data of each image
         """
-        Private method to download the image given by the URL and save it in 'output_dir'.
+        found = False
+        for match in self._RG_META_RE.finditer(html):
+            found = True
+            # The div text comes straight from the HTML, so entities have to be decoded like a parser would do
+            yield unescape(match.group(1).decode('utf-8', 'replace'))
+
+        if not found:
+            self.logger.debug('No image divs found in the results page')
+
+    def _local_filename(self, image_url):
+        """
+        Private method to set the filename of the image given by the URL and update the counter attribute.
 
         :param image_url: Image URL
+        :return: A string with the local filename, or None if the image extension is not allowed
         """
-        self.logger.debug('Getting image URL')
-        # Get image extension
-        extension = image_url.split('.')[-1]
+        # Get image extension from the URL path, so dots in the query string are not taken into account
+        extension = os.path.splitext(urlparse(image_url).path)[1][1:]
 
-        self.logger.debug('Checking if image extension is allowed')
         # If image extension is not in the allowed extensions, return
         if extension.lower() not in self.allowed_exts:
-            self.logger.debug('Image extension not allowed. Returning...')
-            return
+            self.logger.debug('Image extension not allowed: "%s"', image_url)
+            return None
 
-        self.logger.debug('Setting image filename')
         # Set local filename and update counter attribute
-        local_filename = os.path.join(self.output_dir, '%s%s%s.%s' % (self.prefix,
-                                                                      str(self.counter + 1).zfill(self._zfill),
-                                                                      self.suffix,
-                                                                      extension))
+        local_filename = self._name_fmt.format(self.counter + 1, extension)
         self.counter += 1
+        return local_filename
 
-        self.logger.info('"%s" image downloaded from "%s"' % (local_filename, image_url))
-        # Get image bytes and save them in 'local_filename'
+    def _download_image(self, image_url, local_filename):
+        """
+        Private method to download the image given by the URL and save it in 'local_filename'.
+
+        :param image_url: Image URL
+        :param local_filename: A string with the path where the image will be saved
+        :return: A boolean indicating if the image was downloaded
+        """
+        # Get image bytes and save them in 'local_filename'. Files are flushed on close but never fsync'ed: a lost
+        # image is cheap to download again, while forcing it to disk costs far more than the write itself. Keep it
+        # that way if writes move to a temporary file plus atomic rename
         try:
-            r = self.session.get(image_url, stream=True, verify=False)
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    f.write(chunk)
-        except ConnectionError as e:
-            self.logger.error('An error has ocurred: %s' % str(e))
+            # Closing the response returns its connection to the pool, even if the copy fails midway
+            with self.session.get(image_url, stream=True, timeout=self._TIMEOUT) as r:
+                # Do not save error pages as images
+                r.raise_for_status()
+                # Let urllib3 undo any gzip/deflate encoding while the raw stream is copied in 64 KiB blocks
+                r.raw.decode_content = True
+                with open(local_filename, 'wb') as f:
+                    shutil.copyfileobj(r.raw, f, 65536)
+        except (ConnectionError, requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            self.logger.error('An error has ocurred: %s', e)
+            # Do not leave a truncated image behind, it would be taken as downloaded and counted on the next run
+            try:
+                os.remove(local_filename)
+            except FileNotFoundError:
+                pass
+            return False
+
+        self.logger.info('"%s" image downloaded from "%s"', local_filename, image_url)
+        return True
 
     def download_images(self, query, output_dir=None):
         """
@@ -165,38 +223,68 @@ class GoogleImagesScraper(object):
         else:
             self.output_dir = os.path.join(self.output_dir, query.replace(' ', '_'))
 
-        if not os.path.exists(self.output_dir):
-            try:
-                os.makedirs(self.output_dir)
-            except OSError as e:
-                self.logger.info('The directory "%s" already exists.' % self.output_dir)
-            else:
-                self.logger.info('"%s" directory created' % self.output_dir)
-
-        # The counter attribute, used to name image files
-        self.counter = len(os.listdir(self.output_dir))
-
         # Set query param to use in URL
-        self.params['q'] = query.replace(' ', '%20')
-
-        # Make soup and find all image divs
-        soup = self._make_soup()
-        image_divs = soup.findAll('div', {'class': 'rg_meta'})
-
-        self.logger.debug('Traversing image divs to find image URLs')
-        # For each div, create a JSON object and get 'ou' value, which is the image URL and download it
-        for div in image_divs:
-            if images_down < self.limit:
-                self._download_image(json.loads(div.contents[0])['ou'])
-                images_down += 1
-            else:
-                elapsed_time = time.time() - start
-                self.logger.debug('Image limit exceeded. Return images downloaded')
-                self.logger.info('%d images downloaded in %.2f seconds' % (images_down, elapsed_time))
-                return images_down, elapsed_time
+        self.params['q'] = query
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # Request the results page first, and prepare the output directory while waiting for it
+            page = executor.submit(self._get_results_page)
+
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.logger.info('Saving images in "%s"', self.output_dir)
+
+            # Filename template with output directory, prefix, zero-filled counter, suffix and extension. Braces in
+            # the fixed parts are escaped so they are not taken as format fields
+            dirname, prefix, suffix = [x.replace('{', '{{').replace('}', '}}')
+                                       for x in (self.output_dir, self.prefix, self.suffix)]
+            self._name_fmt = os.path.join(dirname, '%s{:0%dd}%s.{}' % (prefix, self._zfill, suffix))
+
+            # The counter attribute, used to name image files. Count the entries while scanning instead of building
+            # the whole listing
+            with os.scandir(self.output_dir) as entries:
+                self.counter = sum(1 for _ in entries)
+
+            self.logger.debug('Traversing image divs to find image URLs')
+            # For each div, get 'ou' value, which is the image URL. Filenames are set here, before dispatching the
+            # downloads, so the counter attribute is only updated from this thread
+            # Google may list the same image more than once, so repeated URLs are skipped
+            downloads = []
+            seen = set()
+            for meta in self._iter_rg_meta(page.result()):
+                # Stop parsing the page once the image limit is reached
+                if len(seen) >= self.limit:
+                    break
+
+                match = self._OU_RE.search(meta)
+                if match is None:
+                    self.logger.debug('Image URL not found in "%s"', meta)
+                    continue
+
+                # Only escaped URLs need to be decoded as a JSON string
+                image_url = match.group(1)
+                if '\\' in image_url:
+                    try:
+                        image_url = json.loads('"%s"' % image_url)
+                    except ValueError:
+                        self.logger.debug('Invalid image URL in "%s"', meta)
+                        continue
+                if image_url in seen:
+                    continue
+                seen.add(image_url)
+
+                local_filename = self._local_filename(image_url)
+                if local_filename is not None:
+                    downloads.append((image_url, local_filename))
+
+            self.logger.debug('Downloading images')
+            futures = [executor.submit(self._download_image, image_url, local_filename)
+                       for image_url, local_filename in downloads]
+            for future in as_completed(futures):
+                if future.result():
+                    images_down += 1
 
         elapsed_time = time.time() - start
-        self.logger.info('%d images downloaded in %.2f seconds' % (images_down, elapsed_time))
+        self.logger.info('%d images downloaded in %.2f seconds', images_down, elapsed_time)
         return images_down, elapsed_time
 
 
@@ -217,9 +305,15 @@ if __name__ == '__main__':
                         help='set prefix for image filenames', default='')
     parser.add_argument('-s', '--suffix', dest='suffix',
                         help='set suffix for image filenames', default='')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        help='max number of images downloaded at the same time (default: 16)', default='16')
 
     opts = parser.parse_args()
 
+    # The thread pool needs at least one worker
+    if opts.workers < 1:
+        parser.error('argument -w/--workers: must be at least 1')
+
     # Store the command-line arguments in dictionary
     kwargs = vars(opts)
 
@@ -230,6 +324,10 @@ if __name__ == '__main__':
     # Format the allowed extensions
     kwargs['exts'] = [x for x in kwargs['exts'].split(',')]
 
+    # Many images come from the same few hosts, so cache name resolution for the lifetime of the process instead of
+    # looking the host up again for every new connection. Failed lookups are not cached
+    socket.getaddrinfo = functools.lru_cache(maxsize=256)(socket.getaddrinfo)
+
     # Create scraper object
     scraper = GoogleImagesScraper(**kwargs)
 